@@ -4,10 +4,11 @@
 import os
 import sys
 import signal
+import socket
 import logging
 import argparse
 import asyncio
-import time
+import functools
 from configparser import ConfigParser
 from configparser import ExtendedInterpolation
 import paho.mqtt.client as mqtt
@@ -30,42 +31,68 @@ args = parser.parse_args()
 # read and parse config file
 config = ConfigParser(interpolation=ExtendedInterpolation())
 config.read(args.config_file)
+MQTT_CFG = dict(config.items("mqtt"))
+VELUX_CFG = dict(config.items("velux"))
+LOG_CFG = dict(config.items("log"))
 # [mqtt]
-MQTT_HOST = config.get("mqtt", "host")
-MQTT_PORT = config.getint("mqtt", "port")
-MQTT_USER = config.get("mqtt", "login")
-MQTT_PW = config.get("mqtt", "password")
-ROOTTOPIC = config.get("mqtt", "roottopic")
-STATUSTOPIC = config.get("mqtt", "statustopic")
+MQTT_HOST = MQTT_CFG["host"]
+MQTT_PORT = int(MQTT_CFG["port"])
+MQTT_USER = MQTT_CFG["login"]
+MQTT_PW = MQTT_CFG["password"]
+ROOTTOPIC = MQTT_CFG["roottopic"]
+STATUSTOPIC = MQTT_CFG["statustopic"]
+MQTT_PROTOCOLS = {
+    "3.1.1": mqtt.MQTTv311,
+    "5": mqtt.MQTTv5,
+}
+# 3.1.1 unless asked for, paho does not fall back from v5 to 3.1.1
+MQTT_PROTOCOL = MQTT_PROTOCOLS.get(MQTT_CFG.get("protocol", "3.1.1"))
+if MQTT_PROTOCOL is None:
+    sys.exit(
+        f"unsupported [mqtt] protocol {MQTT_CFG['protocol']!r}, "
+        f"use one of: {', '.join(MQTT_PROTOCOLS)}"
+    )
 # [velux]
-VLX_HOST = config.get("velux", "host")
-VLX_PW = config.get("velux", "password")
+VLX_HOST = VELUX_CFG["host"]
+VLX_PW = VELUX_CFG["password"]
 # [log]
-LOGFILE = config.get("log", "logfile")
-VERBOSE = config.get("log", "verbose")
+LOGFILE = LOG_CFG["logfile"]
+VERBOSE = config.getboolean("log", "verbose", fallback=False)
 
 APPNAME = "vlx2mqtt"
 
+# payloads for STATUSTOPIC
+STATUS_CONNECTED = b"CONNECTED"
+STATUS_STARTED = b"STARTED"
+STATUS_KLF_AVAILABLE = b"KLF200_available"
+STATUS_DISCONNECTING_KLF = b"DISCONNECTING KLF"
+STATUS_DISCONNECTED_KLF = b"DISCONNECTED KLF"
+STATUS_DISCONNECTED = b"DISCONNECTED"
+
 RUNNING = True
 MQTT_CONN = False
-nodes = {}
+LOOP = None
+CMD_QUEUE = None
+STOP_EVENT = None
+MQTT_CLOSED = None
+MQTT_MISC = None
+PENDING_PUB = {}
+PUB_FLUSH = None
+RECONNECT_DELAY = None
+RECONNECT_TASK = None
+TOPIC_TO_NAME = {}
 
 # init logging
 LOGFORMAT = '%(asctime)-15s %(message)s'
-if VERBOSE:
-    logging.basicConfig(
-        stream=sys.stdout,
-        # ilename=LOGFILE,
-        format=LOGFORMAT,
-        level=logging.DEBUG
-    )
-else:
-    logging.basicConfig(
-        stream=sys.stdout,
-        # filename=LOGFILE,
-        format=LOGFORMAT,
-        level=logging.INFO
-    )
+logging.basicConfig(
+    stream=sys.stdout,
+    # filename=LOGFILE,
+    format=LOGFORMAT,
+    level=logging.DEBUG if VERBOSE else logging.INFO
+)
+
+# for guarding debug output on hot paths
+LOG = logging.getLogger()
 
 logging.info("Starting %s", APPNAME)
 if VERBOSE:
@@ -79,69 +106,179 @@ ch.setLevel(logging.DEBUG)
 PYVLXLOG.addHandler(ch)
 
 # MQTT
-MQTT_CLIENT_ID = APPNAME + "_%d" % os.getpid()
-MQTTC = mqtt.Client(MQTT_CLIENT_ID)
+MQTT_KEEPALIVE = 60
+MQTT_CONNECT_TIMEOUT = 5
+MQTT_RECONNECT_MIN_DELAY = 1
+MQTT_RECONNECT_MAX_DELAY = 60
+PUB_COALESCE_DELAY = 0.01
+MQTT_CLIENT_ID = f"{APPNAME}_{os.getpid()}"
+MQTTC = mqtt.Client(
+    callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
+    client_id=MQTT_CLIENT_ID,
+    protocol=MQTT_PROTOCOL,
+    transport="tcp"
+)
 # if (MQTT_USER is not None and MQTT_PW is not None):
 MQTTC.username_pw_set(MQTT_USER, MQTT_PW)
 
 
-def mqtt_on_connect(client, userdata, flags, return_code):
+def mqtt_on_connect(client, userdata, flags, reason_code, properties):
     '''
-        @return_code
-        0: Connection successful
-        1: Connection refused - incorrect protocol version
-        2: Connection refused - invalid client identifier
-        3: Connection refused - server unavailable
-        4: Connection refused - bad username or password
-        5: Connection refused - not authorised
-        6-255: Currently unused.
+        @reason_code (MQTT v3 return codes are mapped by paho)
+        Success: Connection successful
+        Unsupported protocol version: Connection refused
+        Client identifier not valid: Connection refused
+        Server unavailable / Server busy: Connection refused, retried
+        Bad user name or password: Connection refused
+        Not authorized: Connection refused
     '''
-    _ = (client, userdata, flags)  # pylint: disable=unused-argument
+    _ = (client, userdata, flags, properties)  # pylint: disable=unused-argument
 
     global MQTT_CONN  # pylint: disable=global-statement
-    logging.debug("mqtt_on_connect return_code: %s", str(return_code))
-    if return_code == 0:
+    global RECONNECT_DELAY  # pylint: disable=global-statement
+    logging.debug("mqtt_on_connect reason_code: %s", str(reason_code))
+    if reason_code == 0:
+        RECONNECT_DELAY = None
         logging.info("Connected to %s:%s", MQTT_HOST, MQTT_PORT)
-        MQTTC.publish(STATUSTOPIC, "CONNECTED", retain=True)
-
-        # register devices
-        for node in pyvlx.nodes:
-            if isinstance(node, OpeningDevice):
-                logging.debug("Subscribing to %s/%s/set", ROOTTOPIC, node.name)
-                MQTTC.subscribe(ROOTTOPIC + '/' + node.name + '/set')
+        MQTTC.publish(STATUSTOPIC, STATUS_CONNECTED, retain=True)
+
+        # register devices: one subscription for all of them, unknown nodes
+        # are dropped in mqtt_on_message
+        logging.debug("Subscribing to %s/+/set", ROOTTOPIC)
+        MQTTC.subscribe(ROOTTOPIC + "/+/set", qos=0)
+        # + matches a single level only, names with a / need their own
+        for topic, name in TOPIC_TO_NAME.items():
+            if "/" in name:
+                logging.debug("Subscribing to %s", topic)
+                MQTTC.subscribe(topic, qos=0)
         MQTT_CONN = True
-    elif return_code == 1:
+        # the nodes are loaded before connecting, so this is the final state
+        MQTTC.publish(STATUSTOPIC, STATUS_KLF_AVAILABLE, retain=True)
+    elif reason_code == "Unsupported protocol version":
         logging.info("Connection refused - unacceptable protocol version")
+        if MQTT_PROTOCOL == mqtt.MQTTv5:
+            logging.info("Set protocol = 3.1.1 in [mqtt] for this broker")
         cleanup()
-    elif return_code == 2:
+    elif reason_code == "Client identifier not valid":
         logging.info("Connection refused - identifier rejected")
         cleanup()
-    elif return_code == 3:
-        logging.info("Connection refused - server unavailable")
-        logging.info("Retrying in 10 seconds")
-        time.sleep(10)
-    elif return_code == 4:
+    elif reason_code in ("Server unavailable", "Server busy"):
+        logging.info("Connection refused - %s", str(reason_code).lower())
+        # the broker drops the connection, mqtt_on_disconnect retries
+    elif reason_code == "Bad user name or password":
         logging.info("Connection refused - bad user name or password")
         cleanup()
-    elif return_code == 5:
+    elif reason_code == "Not authorized":
         logging.info("Connection refused - not authorised")
         cleanup()
     else:
-        logging.warning("Something went wrong. RC: %s", str(return_code))
+        logging.warning("Something went wrong. RC: %s", str(reason_code))
         cleanup()
 
 
-def mqtt_on_disconnect(mosq, obj, return_code):
+def mqtt_on_disconnect(mosq, obj, flags, reason_code, properties):
     """ on disconnect """
-    _ = (mosq, obj)  # pylint: disable=unused-argument
+    _ = (mosq, obj, properties)  # pylint: disable=unused-argument
     global MQTT_CONN  # pylint: disable=global-statement
     MQTT_CONN = False
-    if return_code == 0:
-        logging.info("Clean disconnection")
+    if not RUNNING:
+        logging.info("Disconnected from broker while shutting down")
+        logging.debug("reason_code: %s", reason_code)
+        return
+    # while running every disconnect is retried, also a v5 broker's
+    # DISCONNECT with reason 0
+    delay = schedule_reconnect()
+    if flags.is_disconnect_packet_from_server:
+        logging.info(
+            "Disconnected by broker: %s. Reconnecting in %d seconds",
+            reason_code, delay
+        )
+    else:
+        logging.info(
+            "Unexpected disconnection. Reconnecting in %d seconds", delay
+        )
+        logging.debug("reason_code: %s", reason_code)
+
+
+def schedule_reconnect():
+    """ schedule a reconnect on the io loop with exponential backoff """
+    global RECONNECT_DELAY  # pylint: disable=global-statement
+    if RECONNECT_DELAY is None:
+        RECONNECT_DELAY = MQTT_RECONNECT_MIN_DELAY
     else:
-        logging.info("Unexpected disconnection. Reconnecting in 5 seconds")
-        logging.debug("return_code: %s", return_code)
-        time.sleep(5)
+        RECONNECT_DELAY = min(RECONNECT_DELAY * 2, MQTT_RECONNECT_MAX_DELAY)
+    LOOP.call_later(RECONNECT_DELAY, start_reconnect)
+    return RECONNECT_DELAY
+
+
+def start_reconnect():
+    """ run mqtt_reconnect as a task, keeping a reference to it """
+    global RECONNECT_TASK  # pylint: disable=global-statement
+    RECONNECT_TASK = LOOP.create_task(mqtt_reconnect())
+
+
+async def mqtt_reconnect():
+    """ reconnect to the broker, retrying until it succeeds """
+    if not RUNNING:
+        return
+    try:
+        # paho resolves and connects blocking, so check the broker is
+        # reachable without blocking the io loop before handing over
+        _, writer = await asyncio.wait_for(
+            asyncio.open_connection(MQTT_HOST, MQTT_PORT),
+            MQTT_CONNECT_TIMEOUT
+        )
+        writer.close()
+        if RUNNING:
+            MQTTC.reconnect()
+    except (OSError, asyncio.TimeoutError) as err:
+        delay = schedule_reconnect()
+        logging.info(
+            "Reconnect failed: %s. Retrying in %d seconds", err, delay
+        )
+
+
+# paho runs on the io loop: its socket is watched by the loop instead of
+# a separate network thread (see paho's loop_asyncio example)
+def mqtt_on_socket_open(client, userdata, sock):
+    """ start watching the mqtt socket """
+    _ = userdata  # pylint: disable=unused-argument
+    global MQTT_MISC  # pylint: disable=global-statement
+    # our messages are tiny, don't let Nagle hold them back
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    MQTT_CLOSED.clear()
+    LOOP.add_reader(sock, client.loop_read)
+    MQTT_MISC = LOOP.call_later(MQTT_KEEPALIVE / 4, mqtt_misc)
+
+
+def mqtt_on_socket_close(client, userdata, sock):
+    """ stop watching the mqtt socket """
+    _ = (client, userdata)  # pylint: disable=unused-argument
+    LOOP.remove_reader(sock)
+    MQTT_MISC.cancel()
+    MQTT_CLOSED.set()
+
+
+def mqtt_on_socket_register_write(client, userdata, sock):
+    """ paho has data to send """
+    _ = userdata  # pylint: disable=unused-argument
+    LOOP.add_writer(sock, client.loop_write)
+
+
+def mqtt_on_socket_unregister_write(client, userdata, sock):
+    """ paho has sent everything """
+    _ = (client, userdata)  # pylint: disable=unused-argument
+    LOOP.remove_writer(sock)
+
+
+def mqtt_misc():
+    """ keepalive handling, often enough to ping within the keepalive """
+    global MQTT_MISC  # pylint: disable=global-statement
+    MQTTC.loop_misc()
+    # loop_misc() closes the socket on a keepalive timeout, the next
+    # mqtt_on_socket_open starts a new timer
+    if MQTTC.socket() is not None:
+        MQTT_MISC = LOOP.call_later(MQTT_KEEPALIVE / 4, mqtt_misc)
 
 
 def mqtt_on_message(client, userdata, msg):
@@ -149,11 +286,34 @@ def mqtt_on_message(client, userdata, msg):
     _ = (client, userdata)  # pylint: disable=unused-argument
 
     # set OpeningDevice?
-    for node in pyvlx.nodes:
-        if node.name+'/set' not in msg.topic:
-            continue
-        logging.debug("Setting %s to %d%%", node.name, int(msg.payload))
-        nodes[node.name] = int(msg.payload)
+    name = TOPIC_TO_NAME.get(msg.topic)
+    if name is None:
+        return
+    value = parse_percent(msg.payload)
+    if value is None:
+        logging.warning(
+            "Ignoring invalid position for %s: %r", name, msg.payload
+        )
+        return
+    if LOG.isEnabledFor(logging.DEBUG):
+        LOG.debug("Setting %s to %d%%", name, value)
+    CMD_QUEUE.put_nowait((name, value))
+
+
+def parse_percent(payload):
+    """ parse a mqtt payload into a position in percent, None if invalid """
+    try:
+        value = int(payload)
+    except ValueError:
+        return None
+    return value if 0 <= value <= 100 else None
+
+
+@functools.lru_cache(maxsize=128)
+def position_for(percent):
+    """ Position for percent, there are only 101 of them """
+    # pyvlx only reads the position when building the command frame
+    return Position(position_percent=percent)
 
 
 def cleanup(signum=signal.SIGTERM, frame=None):
@@ -162,87 +322,148 @@ def cleanup(signum=signal.SIGTERM, frame=None):
     global RUNNING  # pylint: disable=global-statement
     RUNNING = False
     logging.info("Exiting on signal %d", signum)
+    # wake up the main loop
+    if LOOP is not None:
+        LOOP.call_soon_threadsafe(STOP_EVENT.set)
 
 
 # note: only subclasses of OpeningDevice get registered
-async def vlx_cb(node):
-    """ vlx call back function """
-    global MQTT_CONN  # pylint: disable=global-statement,global-variable-not-assigned
-    if not MQTT_CONN:
-        return
-    logging.debug("%s at %d%%", node.name, node.position.position_percent)
-    MQTTC.publish(
-        ROOTTOPIC + '/' + node.name,
-        node.position.position_percent,
-        retain=False
-    )
+def make_vlx_cb(node):
+    """ vlx call back function for node, with its topic built once """
+    topic = f"{ROOTTOPIC}/{node.name}"
+
+    async def vlx_cb(node, _topic=topic):
+        global MQTT_CONN  # pylint: disable=global-statement,global-variable-not-assigned
+        if not MQTT_CONN:
+            return
+        global PUB_FLUSH  # pylint: disable=global-statement
+        position = node.position.position_percent
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug("%s at %d%%", node.name, position)
+        # a burst of updates (e.g. moving all shutters) is published in one
+        # go, only the latest position per node is sent
+        PENDING_PUB[_topic] = position
+        if PUB_FLUSH is None:
+            PUB_FLUSH = LOOP.call_later(PUB_COALESCE_DELAY, flush_pub)
+
+    return vlx_cb
+
+
+def flush_pub():
+    """ publish the collected node positions """
+    global PUB_FLUSH  # pylint: disable=global-statement
+    PUB_FLUSH = None
+    for topic, payload in PENDING_PUB.items():
+        MQTTC.publish(topic, payload, retain=False)
+    PENDING_PUB.clear()
+
+
+async def dispatch_commands(klf):
+    """ send queued mqtt commands to the KLF until we are told to stop """
+    stop_wait = asyncio.ensure_future(STOP_EVENT.wait())
+    while RUNNING:
+        pending = {}
+        if CMD_QUEUE.empty():
+            # sleep until either a mqtt command arrives or we are told to stop
+            get_cmd = asyncio.ensure_future(CMD_QUEUE.get())
+            await asyncio.wait(
+                [get_cmd, stop_wait],
+                return_when=asyncio.FIRST_COMPLETED
+            )
+            if not get_cmd.done():
+                get_cmd.cancel()
+                break
+            name, value = get_cmd.result()
+            pending[name] = value
+        # collect everything queued so far, the latest command per node wins
+        while True:
+            try:
+                name, value = CMD_QUEUE.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+            pending[name] = value
+
+        # and send them concurrently, a failing node must not stop the others
+        results = await asyncio.gather(*(
+            klf.nodes[name].set_position(position_for(value))
+            for name, value in pending.items()
+        ), return_exceptions=True)
+        for name, result in zip(pending, results):
+            if isinstance(result, Exception):
+                logging.warning("Setting %s failed: %s", name, result)
+    stop_wait.cancel()
 
 
 async def main(loop):
     """ async main loop """
     global RUNNING  # pylint: disable=global-statement,global-variable-not-assigned
     global pyvlx, MQTTC  # pylint: disable=global-statement
+    global LOOP, CMD_QUEUE, STOP_EVENT, MQTT_CLOSED  # pylint: disable=global-statement
+    global TOPIC_TO_NAME  # pylint: disable=global-statement
+    CMD_QUEUE = asyncio.Queue()
+    STOP_EVENT = asyncio.Event()
+    MQTT_CLOSED = asyncio.Event()
+    LOOP = loop
     logging.debug("klf200      : %s", VLX_HOST)
     logging.debug("MQTT broker : %s", MQTT_HOST)
     logging.debug("  port      : %s", str(MQTT_PORT))
     logging.debug("statustopic : %s", str(STATUSTOPIC))
 
-    # Connect to the broker and enter the main loop
-    result = MQTTC.connect(MQTT_HOST, MQTT_PORT, 60)
-    while result != 0:
-        logging.info("Connection failed with error code %s. Retrying", result)
-        await asyncio.sleep(10)
-        result = MQTTC.connect(MQTT_HOST, MQTT_PORT, 60)
-    MQTTC.publish(STATUSTOPIC, "STARTED", retain=True)
-
-    # seems as it must be prior to MQTTC loop.
-    # Otherwise mqtt will not receiving anything...
+    # nodes must be known before mqtt_on_connect subscribes to them,
+    # which can happen as soon as the loop reads the broker's CONNACK
     pyvlx = PyVLX(host=VLX_HOST, password=VLX_PW, loop=loop)
     await pyvlx.load_nodes()
+    opening_nodes = [
+        node for node in pyvlx.nodes if isinstance(node, OpeningDevice)
+    ]
+    TOPIC_TO_NAME = {
+        f"{ROOTTOPIC}/{node.name}/set": node.name for node in opening_nodes
+    }
 
     # Define callbacks
     MQTTC.on_connect = mqtt_on_connect
     MQTTC.on_message = mqtt_on_message
     MQTTC.on_disconnect = mqtt_on_disconnect
+    MQTTC.on_socket_open = mqtt_on_socket_open
+    MQTTC.on_socket_close = mqtt_on_socket_close
+    MQTTC.on_socket_register_write = mqtt_on_socket_register_write
+    MQTTC.on_socket_unregister_write = mqtt_on_socket_unregister_write
 
-    MQTTC.loop_start()
-    await asyncio.sleep(2)
-
-    MQTTC.publish(STATUSTOPIC, "KLF200_available", retain=True)
+    # Connect to the broker
+    result = MQTTC.connect(MQTT_HOST, MQTT_PORT, MQTT_KEEPALIVE)
+    while result != 0:
+        logging.info("Connection failed with error code %s. Retrying", result)
+        await asyncio.sleep(10)
+        result = MQTTC.connect(MQTT_HOST, MQTT_PORT, MQTT_KEEPALIVE)
+    MQTTC.publish(STATUSTOPIC, STATUS_STARTED, retain=True)
 
     logging.debug("vlx nodes   : %s", len(pyvlx.nodes))
     for node in pyvlx.nodes:
         logging.debug("  %s", node.name)
-
-    # register callbacks
-    for node in pyvlx.nodes:
-        if isinstance(node, OpeningDevice):
-            node.register_device_updated_cb(vlx_cb)
-            logging.debug("watching: %s", node.name)
-        else:
+        if not isinstance(node, OpeningDevice):
             logging.debug("   Other node type: %s", type(node))
 
-    while RUNNING:
-        await asyncio.sleep(1)
+    # register callbacks
+    for node in opening_nodes:
+        node.register_device_updated_cb(make_vlx_cb(node))
+        logging.debug("watching: %s", node.name)
 
-        # see if we received some mqtt commands
-        for name, value in list(nodes.items()):
-            if value >= 0:
-                nodes[name] = -1  # mark execuded
-                await pyvlx.nodes[name].set_position(
-                    Position(position_percent=value)
-                )
+    await dispatch_commands(pyvlx)
 
     logging.info("Disconnecting from KLF")
-    MQTTC.publish(STATUSTOPIC, "DISCONNECTING KLF", retain=True)
+    MQTTC.publish(STATUSTOPIC, STATUS_DISCONNECTING_KLF, retain=True)
     await pyvlx.disconnect()
-    MQTTC.publish(STATUSTOPIC, "DISCONNECTED KLF", retain=True)
+    MQTTC.publish(STATUSTOPIC, STATUS_DISCONNECTED_KLF, retain=True)
 
     logging.info("Disconnecting from broker")
     # Publish a retained message to state that this client is offline
-    MQTTC.publish(STATUSTOPIC, "DISCONNECTED", retain=True)
+    MQTTC.publish(STATUSTOPIC, STATUS_DISCONNECTED, retain=True)
     MQTTC.disconnect()
-    MQTTC.loop_stop()
+    # let the loop flush the outstanding messages
+    try:
+        await asyncio.wait_for(MQTT_CLOSED.wait(), 5)
+    except asyncio.TimeoutError:
+        logging.warning("MQTT connection did not close in time")
 
 # Use the signal module to handle signals
 signal.signal(signal.SIGTERM, cleanup)
@@ -251,7 +472,17 @@ signal.signal(signal.SIGINT, cleanup)
 
 if __name__ == '__main__':
     # pylint: disable=invalid-name
-    if sys.version_info.major == 3 and sys.version_info.minor < 10:
+    # uvloop is optional, use it if it is installed
+    try:
+        import uvloop  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        uvloop = None
+
+    if uvloop is not None:
+        logging.debug("using uvloop")
+        io_loop = uvloop.new_event_loop()
+        asyncio.set_event_loop(io_loop)
+    elif sys.version_info.major == 3 and sys.version_info.minor < 10:
         # less than 3.10.0
         io_loop = asyncio.get_event_loop()
     else: